@@ -1,3 +1,5 @@
+import os
+import sqlite3
 import pandas as pd
 import time
 import ast  # safer than eval
@@ -8,6 +10,7 @@ start = time.time()
 csv_file = "all_fragments_data_all.csv"
 chunk_size = 100_000
 index_output = "fragment_index.csv"
+index_db = "fragment_index.sqlite"
 
 total_fragments = 0
 fragment_size_counts = Counter()
@@ -40,6 +43,30 @@ for chunk_id, chunk in enumerate(reader):
 # Save index
 pd.DataFrame(index_rows).to_csv(index_output, index=False)
 
+# Same index as an on-disk B-tree keyed by (entry_id, central_atom, n_atoms, formula_str),
+# so the loader can look up the rows of each pair instead of scanning the CSV above
+if os.path.exists(index_db):
+    os.remove(index_db)
+con = sqlite3.connect(index_db)
+con.execute("""
+    CREATE TABLE fragment_index (
+        entry_id TEXT,
+        central_atom TEXT,
+        n_atoms INTEGER,
+        formula_str TEXT,
+        chunk_id INTEGER,
+        row_in_chunk INTEGER,
+        PRIMARY KEY (entry_id, central_atom, n_atoms, formula_str, chunk_id, row_in_chunk)
+    ) WITHOUT ROWID
+""")
+con.executemany(
+    "INSERT OR IGNORE INTO fragment_index VALUES (?, ?, ?, ?, ?, ?)",
+    ((str(row["entry_id"]).strip().upper(), str(row["formula"][0]), int(row["formula"][1]),
+      str(row["formula"][2]), int(row["chunk_id"]), int(row["row_in_chunk"])) for row in index_rows),
+)
+con.commit()
+con.close()
+
 # Report counts
 print(f"Total fragments: {total_fragments}")
 print("Fragment size distribution:")
@@ -47,5 +74,5 @@ for size, count in sorted(fragment_size_counts.items()):
     percentage = (count / total_fragments) * 100
     print(f"  Size {size}: {count} fragments ({percentage:.2f}%)")
 
-print(f"Index saved to {index_output}")
+print(f"Index saved to {index_output} and {index_db}")
 print(f"Total time elapsed: {time.time() - start:.2f} seconds")
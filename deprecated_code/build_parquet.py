@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import time
+import ast
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import Counter
+
+def build_parquet_from_csv(
+    csv_file="all_fragments_data_all.csv",
+    parquet_path="all_fragments_data_all.parquet",
+    chunk_size=100_000
+):
+    """
+    One-off conversion of `all_fragments_data_all.csv` into a columnar Parquet file
+    with natively typed columns:
+      - entry_id:     dictionary<string>
+      - central_atom: dictionary<string>
+      - n_atoms:      int8
+      - formula_str:  dictionary<string>
+      - fp:           fixed_size_list<float32, N>
+      - sdf:          large_string
+
+    The loader filters it with Arrow predicate pushdown on
+    (entry_id, central_atom, n_atoms, formula_str), so no separate
+    `fragment_index.csv` is needed.
+    """
+
+    start_time = time.time()
+    total_fragments = 0
+    fragment_size_counts = Counter()
+
+    writer = None
+    fp_len = None
+    n_skipped = 0
+
+    reader = pd.read_csv(csv_file, chunksize=chunk_size)
+    for chunk_id, chunk in enumerate(reader):
+        total_fragments += len(chunk)
+        fragment_size_counts.update(chunk["n_atoms"].value_counts().to_dict())
+
+        # Parse row by row, so a malformed formula, n_atoms or fingerprint only
+        # drops its own row. The fingerprint length is fixed by the first
+        # well-formed fingerprint; rows of any other length are dropped too.
+        keep, central_atoms, formula_strs, n_atoms, fps = [], [], [], [], []
+        for pos, (raw_formula, raw_n_atoms, fp_str) in enumerate(zip(chunk["formula"], chunk["n_atoms"], chunk["fp"])):
+            try:
+                central_atom, formula_str = ast.literal_eval(raw_formula)  # like "('C', 'C4H1')"
+                n = int(raw_n_atoms)
+                fp = np.array(fp_str.strip("[] ").split(","), dtype=np.float32)
+            except (ValueError, TypeError, SyntaxError, AttributeError):
+                continue
+            if fp_len is None:
+                fp_len = fp.size
+                schema = pa.schema([
+                    ("entry_id", pa.dictionary(pa.int32(), pa.string())),
+                    ("central_atom", pa.dictionary(pa.int32(), pa.string())),
+                    ("n_atoms", pa.int8()),
+                    ("formula_str", pa.dictionary(pa.int32(), pa.string())),
+                    ("fp", pa.list_(pa.float32(), fp_len)),
+                    ("sdf", pa.large_string()),
+                ])
+                writer = pq.ParquetWriter(parquet_path, schema)
+            if fp.size != fp_len:
+                continue
+            keep.append(pos)
+            central_atoms.append(str(central_atom))
+            formula_strs.append(str(formula_str))
+            n_atoms.append(n)
+            fps.append(fp)
+
+        n_skipped += len(chunk) - len(keep)
+        if not keep:
+            print(f"Skipped chunk {chunk_id}: no well-formed rows.")
+            continue
+        rows = chunk.iloc[keep]
+
+        table = pa.Table.from_arrays([
+            pa.array(rows["entry_id"].astype(str).str.strip().str.upper()).dictionary_encode(),
+            pa.array(central_atoms).dictionary_encode(),
+            pa.array(np.array(n_atoms, dtype=np.int8)),
+            pa.array(formula_strs).dictionary_encode(),
+            pa.FixedSizeListArray.from_arrays(pa.array(np.concatenate(fps)), fp_len),
+            pa.array(rows["sdf"].astype(str), type=pa.large_string()),
+        ], schema=schema)
+        writer.write_table(table)
+
+        print(f"Processed chunk {chunk_id} with {len(rows)} rows ({len(chunk) - len(rows)} malformed rows skipped).")
+
+    if writer is not None:
+        writer.close()
+
+    # Summaries
+    print(f"\nTotal fragments processed: {total_fragments} ({n_skipped} malformed rows skipped)")
+    print("Fragment size distribution:")
+    for size, count in sorted(fragment_size_counts.items()):
+        percentage = (count / total_fragments) * 100
+        print(f"  Size {size}: {count} fragments ({percentage:.2f}%)")
+
+    elapsed = time.time() - start_time
+    print(f"\nAll data written to '{parquet_path}' (fingerprint length {fp_len}).")
+    print(f"Total time elapsed: {elapsed:.2f} seconds")
+
+
+if __name__ == "__main__":
+    build_parquet_from_csv()
@@ -1,30 +1,46 @@
 import os
 import sys
 import time
+import math
+import functools
 import numpy as np
 import pandas as pd
-import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from collections import defaultdict, Counter
+from dataclasses import dataclass
 from ccdc.molecule import Molecule
-from ccdc.io import MoleculeWriter
 from ccdc import io
-from ccdc.entry import Entry
 from hsr import fingerprint as fp
-from hsr import similarity as sim
+
+try:
+    from numba import njit
+except ImportError:  # fall back to the NumPy block scan in compare_group
+    njit = None
 
 os.environ["QT_QPA_PLATFORM"] = "xcb"  # For headless systems
 
 ### ---------- Utility Functions ---------- ###
 
-def get_array_from_ccdcmol(ccdcmol):
-    coords = np.array([
-        [atom.coordinates[0], atom.coordinates[1], atom.coordinates[2], np.sqrt(atom.atomic_number)]
-        for atom in ccdcmol.atoms
-    ])
-    return coords - coords.mean(axis=0)
+def cpu_count():
+    """CPUs this process may run on, honouring its affinity mask (e.g. a cluster job's cpuset)."""
+    if hasattr(os, "process_cpu_count"):  # Python 3.13+
+        return os.process_cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
 
-def fingerprint_key(fp_obj):
-    return tuple(fp_obj.tolist() if isinstance(fp_obj, np.ndarray) else fp_obj)
+# sqrt(Z) for every atomic number, so the 4th coordinate is a lookup instead of a np.sqrt call per atom
+_SQRT_Z = np.sqrt(np.arange(119, dtype=np.float64))
+
+def get_array_from_ccdcmol(ccdcmol):
+    atoms = ccdcmol.atoms
+    coords = np.empty((len(atoms), 4), dtype=np.float64)
+    for i, atom in enumerate(atoms):
+        coords[i, :3] = atom.coordinates
+        coords[i, 3] = _SQRT_Z[atom.atomic_number]
+    coords -= coords.mean(axis=0)
+    return coords
 
 def formula_signature(fragment):
     atoms = fragment.atoms
@@ -36,19 +52,124 @@ def formula_signature(fragment):
 
 
 def generate_fp_data(fragment):
+    sdf = fragment.to_string("sdf")
+    n_atoms = len(fragment.atoms)
     return {
-        "sdf": fragment.to_string("sdf"),
-        "fp": fp.generate_fingerprint_from_data(get_array_from_ccdcmol(fragment)),
+        "sdf": sdf,
+        "fp": np.asarray(fp.generate_fingerprint_from_data(get_array_from_ccdcmol(fragment)), dtype=np.float32),
         "formula": formula_signature(fragment),
-        "n_atoms": len(fragment.atoms),
+        "n_atoms": n_atoms,
         "central_atom": fragment.atoms[0].atomic_symbol,
+        "dist": biatomic_distance(sdf, n_atoms),
     }
 
-def interatomic_distance(sdf_string):
+@dataclass
+class FragGroup:
+    """
+    Fragments sharing one (central_atom, n_atoms, formula_str) key, stored column-wise:
+    fps is a (n, N) float32 matrix, sdfs a list of n SDF strings, n_atoms an int8 array
+    and dists the interatomic distance of biatomic fragments (NaN for the others).
+    """
+    fps: np.ndarray
+    sdfs: list
+    n_atoms: np.ndarray
+    dists: np.ndarray
+
+    def __len__(self):
+        return len(self.sdfs)
+
+    def take(self, rows):
+        return FragGroup(
+            fps=self.fps[rows],
+            sdfs=[self.sdfs[i] for i in rows],
+            n_atoms=self.n_atoms[rows],
+            dists=self.dists[rows],
+        )
+
+    @classmethod
+    def from_frags(cls, frags):
+        return cls(
+            fps=np.stack([frag["fp"] for frag in frags]).astype(np.float32, copy=False),
+            sdfs=[frag["sdf"] for frag in frags],
+            n_atoms=np.array([frag["n_atoms"] for frag in frags], dtype=np.int8),
+            dists=np.array([frag["dist"] for frag in frags], dtype=np.float64),
+        )
+
+def hsr_similarity_matrix(fps_a, fps_b, block_size=64):
+    """
+    Matrix form of hsr.similarity.compute_similarity_score, i.e. 1 / (1 + mean(|a - b|)),
+    for every pair of rows of fps_a (A x N) and fps_b (B x N). Rows of fps_a are
+    processed in blocks to bound the size of the A x B x N difference array.
+    """
+    fps_a = np.asarray(fps_a, dtype=np.float32)
+    fps_b = np.asarray(fps_b, dtype=np.float32)
+    scores = np.empty((len(fps_a), len(fps_b)), dtype=np.float32)
+    for start in range(0, len(fps_a), block_size):
+        diff = np.abs(fps_a[start:start + block_size, None, :] - fps_b[None, :, :])
+        scores[start:start + block_size] = 1.0 / (1.0 + diff.mean(axis=-1))
+    return scores
+
+def l1_norms(fps):
+    return np.abs(fps).sum(axis=1, dtype=np.float64)
+
+def max_l1_distance(threshold, fp_len):
+    # 1 / (1 + |a - b|_1 / N) >= threshold  <=>  |a - b|_1 <= N * (1 / threshold - 1).
+    # Since | |a|_1 - |b|_1 | <= |a - b|_1, pairs whose L1 norms differ by more than
+    # this cannot match; the small margin absorbs float32 rounding in the kernels.
+    return fp_len * (1.0 / threshold - 1.0) * (1.0 + 1e-4)
+
+def parse_interatomic_distance(sdf_string):
+    # V2000 molfile: the counts line is the 4th line and the first atom records
+    # follow it, with x, y, z in fixed 10-character columns. Read those directly
+    # and only fall back to the CCDC parser for anything non-standard.
+    lines = sdf_string.split("\n", 6)
+    try:
+        counts_line = lines[3]
+        if "V3000" not in counts_line and int(counts_line[0:3]) >= 2:
+            a1, a2 = lines[4], lines[5]
+            return math.dist(
+                (float(a1[0:10]), float(a1[10:20]), float(a1[20:30])),
+                (float(a2[0:10]), float(a2[10:20]), float(a2[20:30])),
+            )
+    except (IndexError, ValueError):
+        pass
+
     mol = Molecule.from_string(sdf_string, format="sdf")
     coords = [atom.coordinates for atom in mol.atoms]
     return np.linalg.norm(np.array(coords[0]) - np.array(coords[1]))
 
+# Cached for the target and output-writer lookups, which repeat the same SDFs.
+# Population SDFs are unique, so the loaders use the uncached parser instead of
+# keeping every one of them alive in the cache.
+interatomic_distance = functools.lru_cache(maxsize=65_536)(parse_interatomic_distance)
+
+def biatomic_distance(sdf_string, n_atoms, cached=True):
+    """Interatomic distance of a biatomic fragment; NaN for larger fragments or unreadable SDFs."""
+    if n_atoms != 2:
+        return np.nan
+    try:
+        return interatomic_distance(sdf_string) if cached else parse_interatomic_distance(sdf_string)
+    except Exception:
+        return np.nan
+
+def write_sdf_record(out_f, sdf):
+    """Write an SDF record as-is to an open text file, closing it with $$$$ if needed."""
+    if sdf.rstrip().endswith("$$$$"):
+        out_f.write(sdf.rstrip() + "\n")
+    else:
+        out_f.write(sdf if sdf.endswith("\n") else sdf + "\n")
+        out_f.write("$$$$\n")
+
+def sdf_with_data(sdf, **fields):
+    """The SDF record with a `> <name>` data item appended for each field, closed with $$$$."""
+    record = sdf.rstrip()
+    if record.endswith("$$$$"):
+        record = record[:-4].rstrip()
+    # Data items follow the M  END line directly, and each earlier item ends with a blank line
+    separator = "\n" if record.endswith("M  END") else "\n\n"
+    data = "".join(f"> <{name}>\n{value}\n\n" for name, value in fields.items())
+    return f"{record}{separator}{data}$$$$\n"
+
 ### ---------- Fragmentation Functions ---------- ###
 
 def component_of_interest(molecule):
@@ -86,49 +207,198 @@ def create_fragment(central_atom):
                 pass
     return frag
 
-def get_fragments(mol):
-    return [create_fragment(atom) for atom in mol.atoms]
-
 ### ---------- Target Processing ---------- ###
 
-def process_target(entry_id, threshold=0.999):
+_worker_target_atoms = None
+
+def init_target_worker(entry_id):
+    # CCDC atoms cannot be pickled, so each worker reads the entry once
+    # and the tasks only carry atom indices.
+    global _worker_target_atoms
+    reader = io.EntryReader("CSD")
+    _worker_target_atoms = component_of_interest(reader.entry(entry_id).molecule).atoms
+
+def fragments_fp_data(atom_idxs):
+    return [generate_fp_data(create_fragment(_worker_target_atoms[i])) for i in atom_idxs]
+
+def dedup_formula_group(frags, threshold):
+    # Greedy scan over one precomputed F x F similarity matrix: a fragment is
+    # kept if it is below threshold against every fragment kept before it.
+    group = FragGroup.from_frags(frags)
+    scores = hsr_similarity_matrix(group.fps, group.fps)
+    kept = [0]
+    for i in range(1, len(group)):
+        if scores[i, kept].max() < threshold:
+            kept.append(i)
+    return group.take(kept)
+
+def process_target(entry_id, threshold=0.999, n_processes=None):
+    n_processes = n_processes or cpu_count()
     reader = io.EntryReader("CSD")
     mol = component_of_interest(reader.entry(entry_id).molecule)
-    fragments = get_fragments(mol)
+    n_frags = len(mol.atoms)
 
-    grouped = defaultdict(list)
-    for frag in fragments:
-        data = generate_fp_data(frag)
-        grouped[data["formula"]].append(data)
+    chunk_size = max(1, math.ceil(n_frags / (4 * n_processes)))
+    atom_chunks = [list(range(i, min(i + chunk_size, n_frags))) for i in range(0, n_frags, chunk_size)]
 
-    unique_by_formula = defaultdict(list)
-    for formula, frags in grouped.items():
-        for frag in frags:
-            if all(sim.compute_similarity_score(frag["fp"], other["fp"]) < threshold for other in unique_by_formula[formula]):
-                unique_by_formula[formula].append(frag)
+    # Every worker reads the entry in init_target_worker, so start no more than there are chunks
+    with ProcessPoolExecutor(max_workers=max(1, min(n_processes, len(atom_chunks))),
+                             initializer=init_target_worker, initargs=(entry_id,)) as executor:
+        # executor.map keeps the atom order, which the greedy dedup below depends on
+        grouped = defaultdict(list)
+        for chunk_data in executor.map(fragments_fp_data, atom_chunks):
+            for data in chunk_data:
+                grouped[data["formula"]].append(data)
 
-    return unique_by_formula
+    # The dedup is one small vectorized matrix per formula, cheaper inline than over IPC
+    return {formula: dedup_formula_group(frags, threshold) for formula, frags in grouped.items()}
 
 ### ---------- Chunked Loader ---------- ###
 
-import csv
-import ast
+import sqlite3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
 from collections import defaultdict
 
-def load_population_subset_from_index(pop_ids, formulas, csv_path, index_path="fragment_index.csv", chunk_size=100_000):
+def parse_fp_strings(fp_strings):
+    """
+    Parses fingerprint strings like "[0.1, 0.2, 0.05]" into an (n, N) float32 array.
+    Returns the array and the positions of the strings it holds: a string that does
+    not parse, or whose length differs from the common one, is left out.
+    """
+    fp_strings = list(fp_strings)
+    # Fast path: one np.fromstring call over all strings, valid only if every string
+    # has the same number of values and all of them parsed
+    try:
+        n_values = {fp_str.count(",") + 1 for fp_str in fp_strings}
+        if len(n_values) == 1:
+            fp_len = n_values.pop()
+            fps = np.fromstring(",".join(fp_str.strip("[] ") for fp_str in fp_strings), dtype=np.float32, sep=",")
+            if fps.size == len(fp_strings) * fp_len:
+                return fps.reshape(len(fp_strings), fp_len), np.arange(len(fp_strings))
+    except (AttributeError, TypeError, ValueError):
+        pass
+
+    # Slow path: parse row by row and drop the bad rows
+    parsed = {}
+    for pos, fp_str in enumerate(fp_strings):
+        try:
+            parsed[pos] = np.array(fp_str.strip("[] ").split(","), dtype=np.float32)
+        except (AttributeError, TypeError, ValueError):
+            continue
+    if not parsed:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+    fp_len = Counter(len(fp) for fp in parsed.values()).most_common(1)[0][0]
+    kept = np.array([pos for pos, fp in parsed.items() if len(fp) == fp_len], dtype=np.int64)
+    return np.stack([parsed[pos] for pos in kept.tolist()]), kept
+
+def load_population_subset_from_parquet(pop_ids, formulas, parquet_path, batch_size=100_000):
+    """
+    Same output as load_population_subset_from_index, read from the Parquet file
+    written by build_parquet.py: one dict of FragGroups per record batch. The
+    entry_id / formula filter is pushed down to Arrow, so no index file is needed
+    and fingerprints come out as a 2-D float32 array without any Python-level
+    string parsing.
     """
-    Returns a dict:
+
+    print(f"🔎 Filtering {parquet_path} for {len(pop_ids)} entry_ids and {len(formulas)} formulas...")
+
+    pop_ids = sorted(set(pid.strip().upper() for pid in pop_ids))
+    normalized_formulas = set((str(f[0]), int(f[1]), str(f[2])) for f in formulas)
+    if not pop_ids or not normalized_formulas:
+        return
+
+    formula_filter = None
+    for central_atom, n_atoms, formula_str in normalized_formulas:
+        expr = ((ds.field("central_atom") == central_atom) &
+                (ds.field("n_atoms") == n_atoms) &
+                (ds.field("formula_str") == formula_str))
+        formula_filter = expr if formula_filter is None else (formula_filter | expr)
+    row_filter = ds.field("entry_id").isin(pop_ids) & formula_filter
+
+    dataset = ds.dataset(parquet_path, format="parquet")
+    n_rows = 0
+
+    for batch in dataset.to_batches(columns=["central_atom", "n_atoms", "formula_str", "fp", "sdf"],
+                                    filter=row_filter, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        n_rows += batch.num_rows
+
+        fp_col = batch.column("fp")
+        fps = fp_col.flatten().to_numpy().reshape(-1, fp_col.type.list_size)
+        n_atoms = batch.column("n_atoms").to_numpy()
+        sdfs = batch.column("sdf").to_pylist()
+        dists = np.array([biatomic_distance(sdf, n, cached=False) for sdf, n in zip(sdfs, n_atoms.tolist())],
+                         dtype=np.float64)
+        formula_tuples = zip(batch.column("central_atom").to_pylist(),
+                             n_atoms.tolist(),
+                             batch.column("formula_str").to_pylist())
+
+        rows_by_formula = defaultdict(list)
+        for i, formula_tuple in enumerate(formula_tuples):
+            rows_by_formula[formula_tuple].append(i)
+
+        yield {
+            formula_tuple: FragGroup(
+                fps=fps[rows],
+                sdfs=[sdfs[i] for i in rows],
+                n_atoms=n_atoms[rows],
+                dists=dists[rows],
+            ) for formula_tuple, rows in rows_by_formula.items()
+        }
+
+    if not n_rows:
+        print("⚠️ No matching fragments found in parquet file!")
+        return
+
+    print(f"✅ Loaded {n_rows} rows.")
+
+def lookup_fragment_index(pop_ids, formula_list, index_db_path):
+    """
+    Looks up the (chunk_id, row_in_chunk) of every fragment of pop_ids with one of
+    the formulas in the SQLite index written by build_index.py. Returns the chunk ids,
+    row indexes and codes into formula_list of the matches, plus the number of
+    distinct entry_ids matched.
+    """
+    con = sqlite3.connect(f"file:{index_db_path}?mode=ro", uri=True)
+    try:
+        con.execute("CREATE TEMP TABLE wanted_ids (entry_id TEXT PRIMARY KEY)")
+        con.executemany("INSERT INTO wanted_ids VALUES (?)", ((pid,) for pid in pop_ids))
+        con.execute("CREATE TEMP TABLE wanted_formulas (code INTEGER, central_atom TEXT, n_atoms INTEGER, formula_str TEXT)")
+        con.executemany("INSERT INTO wanted_formulas VALUES (?, ?, ?, ?)",
+                        ((code, *formula) for code, formula in enumerate(formula_list)))
+        # CROSS JOIN pins the loop order, so every (entry_id, formula) pair is one
+        # primary key seek into fragment_index and the cost follows the hits
+        rows = con.execute("""
+            SELECT i.chunk_id, i.row_in_chunk, f.code, i.entry_id
+            FROM wanted_ids w
+            CROSS JOIN wanted_formulas f
+            CROSS JOIN fragment_index i
+            WHERE i.entry_id = w.entry_id
+              AND i.central_atom = f.central_atom
+              AND i.n_atoms = f.n_atoms
+              AND i.formula_str = f.formula_str
+        """).fetchall()
+    finally:
+        con.close()
+
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64), 0
+    chunk_ids, row_idxs, formula_codes, entry_ids = zip(*rows)
+    return (np.array(chunk_ids, dtype=np.int64), np.array(row_idxs, dtype=np.int64),
+            np.array(formula_codes, dtype=np.int64), len(set(entry_ids)))
+
+def load_population_subset_from_index(pop_ids, formulas, csv_path, index_path="fragment_index.csv", chunk_size=100_000,
+                                      index_db_path="fragment_index.sqlite"):
+    """
+    Generator over the population fragments, yielding one dict per chunk of
+    csv_path that holds matching rows:
        {
-          (central_atom, n_atoms, formula_str): [
-              {
-                 'fp': [float, float, ...],
-                 'sdf': str,
-                 'n_atoms': int,
-                 'formula': (central_atom, n_atoms, formula_str)
-              },
-              ...
-          ],
+          (central_atom, n_atoms, formula_str): FragGroup(fps, sdfs, n_atoms, dists),
           ...
        }
 
@@ -138,8 +408,17 @@ def load_population_subset_from_index(pop_ids, formulas, csv_path, index_path="f
     index_path: path to 'fragment_index.csv' which has columns:
                 chunk_id, row_in_chunk, entry_id, formula
     chunk_size: how many rows at a time to read from csv_path.
+    index_db_path: the SQLite version of the index, also written by build_index.py.
+                When it exists it is queried instead of scanning index_path.
+
+    If csv_path points to a .parquet file (see build_parquet.py) the index is not
+    used and loading is delegated to load_population_subset_from_parquet.
     """
 
+    if csv_path.endswith(".parquet"):
+        yield from load_population_subset_from_parquet(pop_ids, formulas, csv_path, batch_size=chunk_size)
+        return
+
     print(f"🔎 Filtering index for {len(pop_ids)} entry_ids and {len(formulas)} formulas...")
 
     # Normalize entry IDs and formulas for consistent comparison:
@@ -150,84 +429,103 @@ def load_population_subset_from_index(pop_ids, formulas, csv_path, index_path="f
     print("🔬 Sample normalized formula:", next(iter(normalized_formulas)))
     print("📋 Sample normalized pop_ids:", list(pop_ids)[:5])
 
-    # We'll track rows to read from the big CSV in rows_by_chunk:
-    #   rows_by_chunk[chunk_id] = [row_index1, row_index2, ...]
-    rows_by_chunk = defaultdict(list)
-    matched_ids = set()
-
-    # 1) Safely read fragment_index.csv using csv.DictReader
-    with open(index_path, newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            try:
-                chunk_id = int(row['chunk_id'])
-                row_in_chunk = int(row['row_in_chunk'])
-                entry_id = row['entry_id'].strip().upper()
-                formula_str = row['formula']  # e.g. "('C', 5, 'C4H1')"
-
-                # Convert the string in "formula" column into a tuple
-                formula_raw = ast.literal_eval(formula_str)
-                # Force it into the shape (str, int, str)
-                formula_parsed = (str(formula_raw[0]), int(formula_raw[1]), str(formula_raw[2]))
-
-                # If this entry is one of our population IDs and the formula is one of our target formulas:
-                if entry_id in pop_ids and formula_parsed in normalized_formulas:
-                    rows_by_chunk[chunk_id].append(row_in_chunk)
-                    matched_ids.add(entry_id)
-
-            except Exception:
-                # If something is malformed, skip it
-                continue
+    formula_list = sorted(normalized_formulas)
+    if os.path.exists(index_db_path):
+        # 1) Keyed lookups in the SQLite index, proportional to the matches
+        #    rather than to the size of the index
+        chunk_ids, row_idxs, formula_codes, n_matched_ids = lookup_fragment_index(
+            sorted(pop_ids), formula_list, index_db_path)
+    else:
+        # 1) Fallback: read fragment_index.csv with Arrow's multi-threaded CSV parser
+        #    and filter it with vectorized compute kernels. The formula column holds the
+        #    repr of the (central_atom, n_atoms, formula_str) tuple, so it is matched as a string.
+        index_tbl = pa_csv.read_csv(
+            index_path,
+            read_options=pa_csv.ReadOptions(use_threads=True),
+            parse_options=pa_csv.ParseOptions(invalid_row_handler=lambda row: "skip"),
+            convert_options=pa_csv.ConvertOptions(column_types={
+                "chunk_id": pa.string(),
+                "row_in_chunk": pa.string(),
+                "entry_id": pa.string(),
+                "formula": pa.string(),
+            }),
+        )
+        # chunk_id/row_in_chunk are read as strings and non-integer rows are dropped,
+        # since a failed int64 conversion would abort the whole read
+        chunk_id_strs = pc.utf8_trim_whitespace(index_tbl["chunk_id"])
+        row_in_chunk_strs = pc.utf8_trim_whitespace(index_tbl["row_in_chunk"])
+        formula_reprs = pa.array([str(f) for f in formula_list])
+        index_entry_ids = pc.utf8_upper(pc.utf8_trim_whitespace(index_tbl["entry_id"]))
+        mask = pc.and_(
+            pc.and_(pc.utf8_is_digit(chunk_id_strs), pc.utf8_is_digit(row_in_chunk_strs)),
+            pc.and_(
+                pc.is_in(index_entry_ids, value_set=pa.array(sorted(pop_ids))),
+                pc.is_in(index_tbl["formula"], value_set=formula_reprs),
+            ),
+        )
+        matched = index_tbl.filter(mask)
+        n_matched_ids = pc.count_distinct(pc.filter(index_entry_ids, mask)).as_py()
+        chunk_ids = pc.cast(pc.filter(chunk_id_strs, mask), pa.int64()).to_numpy()
+        row_idxs = pc.cast(pc.filter(row_in_chunk_strs, mask), pa.int64()).to_numpy()
+        formula_codes = pc.index_in(matched["formula"], value_set=formula_reprs).to_numpy()
+
+    # 2) Bucket the matched rows by chunk, keeping each row's formula as a code into
+    #    formula_list: rows_by_chunk[chunk_id] = (row indexes, formula codes)
+    order = np.lexsort((row_idxs, chunk_ids))
+    chunk_ids, row_idxs, formula_codes = chunk_ids[order], row_idxs[order], formula_codes[order]
+    unique_chunks, chunk_starts = np.unique(chunk_ids, return_index=True)
+    rows_by_chunk = dict(zip(unique_chunks.tolist(),
+                             zip(np.split(row_idxs, chunk_starts[1:]), np.split(formula_codes, chunk_starts[1:]))))
 
     # If we found no matching lines in the index, just return empty.
     if not rows_by_chunk:
         print("⚠️ No matching fragments found in index!")
-        return {}
+        return
 
     # Print some stats about how many rows and how many unique entry_ids we matched
-    print(f"✅ Found {sum(len(v) for v in rows_by_chunk.values())} rows across {len(rows_by_chunk)} chunks.")
-    print(f"🧩 Total unique matched entry_ids: {len(matched_ids)}")
+    print(f"✅ Found {len(row_idxs)} rows across {len(rows_by_chunk)} chunks.")
+    print(f"🧩 Total unique matched entry_ids: {n_matched_ids}")
 
-    # 2) Now we actually load the big CSV (csv_path), chunk by chunk,
+    # 3) Now we actually load the big CSV (csv_path), chunk by chunk,
     #    but only the rows we need from each chunk.
-    pop_group = defaultdict(list)
     reader = pd.read_csv(csv_path, chunksize=chunk_size)
     for chunk_id, chunk in enumerate(reader):
         if chunk_id not in rows_by_chunk:
             continue
 
-        # row indexes from index file
-        row_idxs = rows_by_chunk[chunk_id]
+        # row indexes from index file; they are labels of the reader's running
+        # index (not positions within the chunk), hence .loc
+        row_idxs, codes = rows_by_chunk[chunk_id]
 
         try:
-            subset = chunk.loc[row_idxs]
+            subset = chunk.loc[row_idxs, ["fp", "sdf", "n_atoms"]]
         except KeyError:
             print(f"⚠️ Skipping chunk {chunk_id} due to missing row indexes.")
             continue
 
-        # Build the pop_group dictionary from relevant rows
-        for _, row in subset.iterrows():
-            try:
-                # row["formula"] is like "('C', 5, 'C4H1')"
-                parsed = ast.literal_eval(row["formula"])
-                formula_tuple = (str(parsed[0]), int(parsed[1]), str(parsed[2]))
-
-                # Convert the fingerprint string (like "[0.1, 0.2, 0.05]") to float list
-                fp_floats = [float(x) for x in row["fp"].strip("[] ").split(",")]
-
-                frag = {
-                    "fp": fp_floats,
-                    "sdf": row["sdf"],
-                    "n_atoms": row["n_atoms"],
-                    "formula": formula_tuple
-                }
-                pop_group[formula_tuple].append(frag)
-
-            except Exception:
-                # skip malformed lines in the big CSV
+        fps, kept = parse_fp_strings(subset["fp"])
+        if len(kept) < len(subset):
+            print(f"⚠️ Skipping {len(subset) - len(kept)} rows of chunk {chunk_id} with malformed fingerprints.")
+            subset, codes = subset.iloc[kept], codes[kept]
+            if subset.empty:
                 continue
 
-    return pop_group
+        n_atoms = subset["n_atoms"].to_numpy(dtype=np.int8)
+        sdfs = subset["sdf"].tolist()
+        dists = np.array([biatomic_distance(sdf, n, cached=False) for sdf, n in zip(sdfs, n_atoms.tolist())],
+                         dtype=np.float64)
+
+        # Split the chunk's rows by formula code
+        order = np.argsort(codes, kind="stable")
+        unique_codes, code_starts = np.unique(codes[order], return_index=True)
+        yield {
+            formula_list[code]: FragGroup(
+                fps=fps[rows],
+                sdfs=[sdfs[i] for i in rows],
+                n_atoms=n_atoms[rows],
+                dists=dists[rows],
+            ) for code, rows in zip(unique_codes.tolist(), np.split(order, code_starts[1:]))
+        }
 
 
 
@@ -294,117 +592,256 @@ def load_population_subset_from_index(pop_ids, formulas, csv_path, index_path="f
 
 ### ---------- Similarity Comparison ---------- ###
 
-def compare_group(args):
-    target_group, pop_group, threshold = args
-    target_status = {
-        fingerprint_key(t["fp"]): {
-            "data": t,
-            "top_matches": [],
-            "matched": False
-        } for t in target_group
+def _shared_target_arrays(shm, layout):
+    n_rows, fp_len = layout["n_rows"], layout["fp_len"]
+    fps = np.ndarray((n_rows, fp_len), dtype=np.float32, buffer=shm.buf)
+    dists = np.ndarray((n_rows,), dtype=np.float64, buffer=shm.buf, offset=layout["dists_offset"])
+    n_atoms = np.ndarray((n_rows,), dtype=np.int8, buffer=shm.buf, offset=layout["n_atoms_offset"])
+    return fps, dists, n_atoms
+
+def pack_target_groups(target_frags):
+    """
+    Copies the fps, dists and n_atoms of all target groups into one shared memory
+    segment. Returns the segment and a picklable layout with, for each formula,
+    its (start, stop) row range in the packed arrays.
+    """
+    n_rows = sum(len(group) for group in target_frags.values())
+    fp_len = next(iter(target_frags.values())).fps.shape[1]
+    fps_bytes = n_rows * fp_len * np.dtype(np.float32).itemsize
+    dists_offset = -(-fps_bytes // 8) * 8  # keep the float64 block 8-byte aligned
+    n_atoms_offset = dists_offset + n_rows * np.dtype(np.float64).itemsize
+    layout = {
+        "n_rows": n_rows,
+        "fp_len": fp_len,
+        "dists_offset": dists_offset,
+        "n_atoms_offset": n_atoms_offset,
+        "rows": {},
     }
-    unmatched_keys = set(target_status.keys())
-
-    for pop in pop_group:
-        pop_fp = pop["fp"]
-        pop_sdf = pop["sdf"]
-        pop_formula = pop["formula"]
-        pop_atoms = pop["n_atoms"]
-
-        to_remove = []
-
-        for key in unmatched_keys:
-            t = target_status[key]["data"]
-            is_both_biatomic = t["n_atoms"] == 2 and pop_atoms == 2
-
-            if is_both_biatomic and t["formula"] == pop_formula:
-                try:
-                    t_dist = interatomic_distance(t["sdf"])
-                    p_dist = interatomic_distance(pop_sdf)
-                    diff = abs(t_dist - p_dist)
-                    if diff <= 0.01:
-                        score = 1.0 - diff
-                        target_status[key]["top_matches"].append((score, pop_sdf))
-                        target_status[key]["matched"] = True
-                        to_remove.append(key)
-                except:
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, n_atoms_offset + n_rows))
+    fps, dists, n_atoms = _shared_target_arrays(shm, layout)
+    start = 0
+    for formula, group in target_frags.items():
+        stop = start + len(group)
+        fps[start:stop] = group.fps
+        dists[start:stop] = group.dists
+        n_atoms[start:stop] = group.n_atoms
+        layout["rows"][formula] = (start, stop)
+        start = stop
+    return shm, layout
+
+_worker_shm = None
+_worker_targets = None
+
+def init_worker(shm_name, layout):
+    # Attach once per worker; compare_group then takes zero-copy views by formula
+    global _worker_shm, _worker_targets
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    fps, dists, n_atoms = _shared_target_arrays(_worker_shm, layout)
+    norms = l1_norms(fps)
+    _worker_targets = {
+        formula: (fps[start:stop], n_atoms[start:stop], dists[start:stop], norms[start:stop])
+        for formula, (start, stop) in layout["rows"].items()
+    }
+
+def compare_kernel_numpy(t_fps, t_n_atoms, t_dists, t_norms, p_fps, p_n_atoms, p_dists, p_norms,
+                         threshold, max_l1, pop_block_size=256):
+    """
+    For each target, the index and score of the first population fragment that
+    matches it (-1 if none): biatomic pairs match when their interatomic distances
+    differ by at most 0.01 (score 1 - diff), all other pairs when their HSR
+    similarity reaches threshold. The population is scored in blocks, one
+    similarity matrix per block, and matched targets drop out of later blocks.
+    Only pairs whose L1 norms (t_norms, p_norms) are within max_l1 of each other
+    can reach threshold, so the other columns of a block are not scored.
+    """
+    n_targets = len(t_fps)
+    match_idx = np.full(n_targets, -1, dtype=np.int64)
+    match_score = np.zeros(n_targets, dtype=np.float64)
+    unmatched = np.ones(n_targets, dtype=bool)
+    t_biatomic = t_n_atoms == 2
+
+    # Rows of the still unmatched targets, gathered again only after a block with hits
+    idx = np.arange(n_targets)
+    open_fps, open_biatomic, open_dists, open_norms = t_fps, t_biatomic, t_dists, t_norms
+
+    for start in range(0, len(p_fps), pop_block_size):
+        stop = min(start + pop_block_size, len(p_fps))
+        close = np.abs(open_norms[:, None] - p_norms[None, start:stop]) <= max_l1
+        scores = np.zeros(close.shape, dtype=np.float32)
+        cols = np.flatnonzero(close.any(axis=0))
+        if cols.size:
+            scores[:, cols] = hsr_similarity_matrix(open_fps, p_fps[start + cols])
+
+        # Biatomic pairs are compared by their precomputed interatomic distances
+        # instead of fingerprints (NaN distances never match)
+        p_biatomic = p_n_atoms[start:stop] == 2
+        both_biatomic = open_biatomic[:, None] & p_biatomic[None, :]
+        dist_diff = np.abs(open_dists[:, None] - p_dists[None, start:stop])
+        biatomic_hits = both_biatomic & (dist_diff <= 0.01)
+        scores = np.where(biatomic_hits, 1.0 - dist_diff, scores)
+        hits = biatomic_hits | (~both_biatomic & close & (scores >= threshold))
+
+        has_hit = hits.any(axis=1)
+        if not has_hit.any():
+            continue
+        first_hit = hits.argmax(axis=1)[has_hit]
+        matched_rows = idx[has_hit]
+        match_idx[matched_rows] = start + first_hit
+        match_score[matched_rows] = scores[has_hit, first_hit]
+        unmatched[matched_rows] = False
+
+        idx = np.flatnonzero(unmatched)
+        if idx.size == 0:
+            break
+        open_fps, open_biatomic, open_dists, open_norms = t_fps[idx], t_biatomic[idx], t_dists[idx], t_norms[idx]
+
+    return match_idx, match_score
+
+def _compare_kernel_loops(t_fps, t_n_atoms, t_dists, t_norms, p_fps, p_n_atoms, p_dists, p_norms,
+                          threshold, max_l1):
+    # Same contract as compare_kernel_numpy, written as plain loops for Numba:
+    # each target stops scanning the population at its first hit.
+    n_targets, fp_len = t_fps.shape
+    n_pop = p_fps.shape[0]
+    match_idx = np.full(n_targets, -1, dtype=np.int64)
+    match_score = np.zeros(n_targets, dtype=np.float64)
+
+    for i in range(n_targets):
+        for j in range(n_pop):
+            if t_n_atoms[i] == 2 and p_n_atoms[j] == 2:
+                diff = abs(t_dists[i] - p_dists[j])
+                if not diff <= 0.01:
                     continue
-            elif not is_both_biatomic:
-                score = sim.compute_similarity_score(t["fp"], pop_fp)
-                if score >= threshold:
-                    target_status[key]["top_matches"].append((score, pop_sdf))
-                    target_status[key]["matched"] = True
-                    to_remove.append(key)
-
-            target_status[key]["top_matches"].sort(key=lambda x: -x[0])
-            target_status[key]["top_matches"] = target_status[key]["top_matches"][:3]
-
-        unmatched_keys -= set(to_remove)
-        if not unmatched_keys:
+                score = 1.0 - diff
+            else:
+                if abs(t_norms[i] - p_norms[j]) > max_l1:
+                    continue
+                # Summing in float32 keeps the reduction at the fingerprints' own
+                # width; its error is far below the 1e-3 L1 margin of a 0.999
+                # threshold, whereas float16 fingerprints alone would exceed it
+                acc = np.float32(0.0)
+                for k in range(fp_len):
+                    acc += abs(t_fps[i, k] - p_fps[j, k])
+                score = 1.0 / (1.0 + acc / fp_len)
+                if score < threshold:
+                    continue
+            match_idx[i] = j
+            match_score[i] = score
             break
 
-    return [
-        (key, {
-            "target_sdf": info["data"]["sdf"],
-            "top_matches": info["top_matches"],
-            "matched": info["matched"]
-        }) for key, info in target_status.items()
-    ]
+    return match_idx, match_score
 
-def compare_fragments_parallel(target_frags, pop_fragments_gen, threshold=0.999, n_processes=8):
+if njit is not None:
+    # No "nnan" flag: NaN distances of unreadable biatomic SDFs must never match
+    compare_kernel = njit(cache=True, fastmath={"reassoc", "contract", "arcp"})(_compare_kernel_loops)
+else:
+    compare_kernel = compare_kernel_numpy
+
+def compare_group(args):
+    # Only the population arrays travel to the worker; the SDFs stay in the
+    # parent, which resolves the returned row indexes itself.
+    key, p_fps, p_n_atoms, p_dists, threshold = args
+    t_fps, t_n_atoms, t_dists, t_norms = _worker_targets[key]
+
+    fp_len = t_fps.shape[1]
+    match_idx, match_score = compare_kernel(t_fps, t_n_atoms, t_dists, t_norms,
+                                            p_fps, p_n_atoms, p_dists, l1_norms(p_fps),
+                                            threshold, max_l1_distance(threshold, fp_len))
+    return match_idx, match_score
+
+def compare_fragments_parallel(target_frags, pop_fragments_gen, threshold=0.999, n_processes=None):
     from time import perf_counter
 
     all_results = defaultdict(lambda: {
         "target_sdf": None,
         "top_matches": [],
-        "matched": False
+        "matched": False,
+        "first_hit": None  # (population index, score, sdf) of the earliest match
     })
+    if not target_frags:
+        return {}
 
-    print(f"🧩 Preparing group comparison tasks...")
-    prep_start = perf_counter()
-
-    tasks = []
-    chunk_idx = 0
-    total_pop_groups = 0
-
-    for pop_group in pop_fragments_gen:
-        chunk_idx += 1
-        chunk_start = perf_counter()
-
-        matches_this_chunk = 0
-        for key, pop_list in pop_group.items():
-            total_pop_groups += 1
-            if key in target_frags:
-                tasks.append((target_frags[key], pop_list, threshold))
-                matches_this_chunk += 1
-
-        chunk_end = perf_counter()
-        print(f"  🔹 Processed chunk {chunk_idx} in {chunk_end - chunk_start:.2f}s "
-              f"(matched {matches_this_chunk} target formulas)", flush=True)
-
-    prep_end = perf_counter()
-    print(f"🛠️ Prepared {len(tasks)} group tasks from {chunk_idx} chunks in {prep_end - prep_start:.2f}s")
+    n_processes = n_processes or cpu_count()
+    # Tasks in flight at once; bounds how many loaded batches are held in memory
+    max_pending = 4 * n_processes
+    pending = {}
+    # Rows of each formula's population submitted so far, so that a row's index
+    # within its batch can be turned into its index in the whole population
+    pop_offsets = defaultdict(int)
+
+    def merge(future):
+        formula, pop_group, offset = pending.pop(future)
+        match_idx, match_score = future.result()
+        target_sdfs = target_frags[formula].sdfs
+        # Each target keeps its first hit in the population scan. A batch only
+        # knows its own first hit, so the earliest one over all batches wins and
+        # the result does not depend on how the population was split.
+        for i, j in enumerate(match_idx.tolist()):
+            key = (formula, i)
+            all_results[key]["target_sdf"] = target_sdfs[i]
+            if j < 0:
+                continue
+            first_hit = all_results[key]["first_hit"]
+            if first_hit is None or offset + j < first_hit[0]:
+                all_results[key]["first_hit"] = (offset + j, float(match_score[i]), pop_group.sdfs[j])
+            all_results[key]["matched"] = True
 
     print(f"🚀 Starting multiprocessing with {n_processes} processes...")
     mp_start = perf_counter()
 
-    with mp.Pool(n_processes) as pool:
-        for batch in pool.imap_unordered(compare_group, tasks):
-            for key, result in batch:
-                all_results[key]["target_sdf"] = result["target_sdf"]
-                all_results[key]["top_matches"].extend(result["top_matches"])
-                all_results[key]["matched"] |= result["matched"]
-                all_results[key]["top_matches"].sort(key=lambda x: -x[0])
-                all_results[key]["top_matches"] = all_results[key]["top_matches"][:3]
+    n_tasks = 0
+    chunk_idx = 0
+
+    # Target arrays are shared once with every worker instead of being pickled per task
+    shm, layout = pack_target_groups(target_frags)
+    try:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=init_worker,
+                                 initargs=(shm.name, layout)) as executor:
+            # Groups are submitted as the loader yields them, so workers compare
+            # one batch while the next one is still being read
+            for pop_group in pop_fragments_gen:
+                chunk_idx += 1
+                chunk_start = perf_counter()
+
+                matches_this_chunk = 0
+                for key, pop_list in pop_group.items():
+                    if key not in target_frags:
+                        continue
+                    while len(pending) >= max_pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            merge(future)
+                    task = (key, pop_list.fps, pop_list.n_atoms, pop_list.dists, threshold)
+                    pending[executor.submit(compare_group, task)] = (key, pop_list, pop_offsets[key])
+                    pop_offsets[key] += len(pop_list)
+                    matches_this_chunk += 1
+                n_tasks += matches_this_chunk
+
+                chunk_end = perf_counter()
+                print(f"  🔹 Processed chunk {chunk_idx} in {chunk_end - chunk_start:.2f}s "
+                      f"(matched {matches_this_chunk} target formulas)", flush=True)
+
+            for future in wait(pending).done:
+                merge(future)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    for result in all_results.values():
+        first_hit = result.pop("first_hit")
+        if first_hit is not None:
+            result["top_matches"] = [first_hit[1:]]
 
     mp_end = perf_counter()
+    print(f"🛠️ Compared {n_tasks} group tasks from {chunk_idx} chunks")
     print(f"✅ Finished multiprocessing in {mp_end - mp_start:.2f}s")
 
     return dict(all_results)
 
 ### ---------- Main ---------- ###
 
-def run_analysis(entry_id, population_file, idx, csv_path="all_fragments_data_all.csv", threshold=0.999):
+def run_analysis(entry_id, population_file, idx, csv_path="all_fragments_data_all.parquet", threshold=0.999):
     start = time.time()
     print(f"\n🔍 Target: {entry_id}")
 
@@ -422,51 +859,50 @@ def run_analysis(entry_id, population_file, idx, csv_path="all_fragments_data_al
         pop_ids = [line.split()[0] for line in f if line.strip()]
     print(f"⚙️ Population size: {len(pop_ids)}")
     
-    t2 = time.time()
-    pop_group = load_population_subset_from_index(
+    # Lazy: batches are read as compare_fragments_parallel consumes them
+    pop_fragments_gen = load_population_subset_from_index(
                 pop_ids=pop_ids,
-                formulas=target_frags.keys(),
-                csv_path="all_fragments_data_all.csv",
+                formulas=list(target_frags.keys()),
+                csv_path=csv_path,
                 index_path="fragment_index.csv")
-    pop_fragments_gen = [pop_group]  # single-chunk generator format
 
     print(f"📦 Started loading population fragments...")
 
     t3 = time.time()
-    comparisons = compare_fragments_parallel(target_frags, pop_fragments_gen, threshold=0.99, n_processes=8)
+    comparisons = compare_fragments_parallel(target_frags, pop_fragments_gen, threshold=0.99)
     t4 = time.time()
-    print(f"🔗 Similarity comparison done in {t4 - t3:.2f}s")
+    print(f"🔗 Population loading and similarity comparison done in {t4 - t3:.2f}s")
 
     matched = sum(1 for v in comparisons.values() if v["matched"])
     print(f"📊 Matched {matched}/{total} fragments.")
 
     t5 = time.time()
-    with MoleculeWriter(os.path.join(output_dir, f"{idx}_{entry_id}_target_unique_fragments.sdf")) as w:
+    with open(os.path.join(output_dir, f"{idx}_{entry_id}_target_unique_fragments.sdf"), "w") as out_f:
         for group in target_frags.values():
-            for frag in group:
-                w.write(Molecule.from_string(frag["sdf"], format="sdf"))
+            for sdf in group.sdfs:
+                write_sdf_record(out_f, sdf)
     print(f"🧪 Wrote target fragments SDF in {time.time() - t5:.2f}s")
 
     t6 = time.time()
-    for i, (fp_key, comp) in enumerate(comparisons.items(), start=1):
+    for i, (frag_key, comp) in enumerate(comparisons.items(), start=1):
+        formula, t_idx = frag_key
+        target_group = target_frags[formula]
+        # Matches share the target formula key, hence its number of atoms
+        is_biatomic = target_group.n_atoms[t_idx] == 2
+
         output_path = os.path.join(output_dir, f"{idx}_{entry_id}_frag{i}_matches.sdf")
-        with MoleculeWriter(output_path) as writer:
-            target_mol = Molecule.from_string(comp["target_sdf"], format="sdf")
-            writer.write(target_mol)
+        with open(output_path, "w") as out_f:
+            write_sdf_record(out_f, comp["target_sdf"])
 
             for sim_score, sdf in comp["top_matches"]:
-                match_mol = Molecule.from_string(sdf, format="sdf")
-                match_entry = Entry.from_molecule(match_mol)
-                if len(match_mol.atoms) == 2 and len(target_mol.atoms) == 2:
-                    try:
-                        d1 = interatomic_distance(target_mol.to_string("sdf"))
-                        d2 = interatomic_distance(match_mol.to_string("sdf"))
-                        match_entry.attributes["DistanceDifference"] = f"{abs(d1 - d2):.4f}"
-                    except:
-                        match_entry.attributes["DistanceDifference"] = "ERROR"
+                if is_biatomic:
+                    dist_diff = abs(target_group.dists[t_idx] - biatomic_distance(sdf, 2))
+                    if np.isnan(dist_diff):
+                        out_f.write(sdf_with_data(sdf, DistanceDifference="ERROR"))
+                    else:
+                        out_f.write(sdf_with_data(sdf, DistanceDifference=f"{dist_diff:.4f}"))
                 else:
-                    match_entry.attributes["Similarity"] = f"{sim_score:.4f}"
-                writer.write_entry(match_entry)
+                    out_f.write(sdf_with_data(sdf, Similarity=f"{sim_score:.4f}"))
     print(f"📁 Wrote match SDFs in {time.time() - t6:.2f}s")
 
     print(f"✅ Done with target {entry_id} in {time.time() - start:.2f}s")